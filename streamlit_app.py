@@ -8,134 +8,873 @@ e utiliza a API do Google Gemini para extrair dados estruturados.
 
 # 1. Imports necessários
 import streamlit as st
-from PIL import Image
+from PIL import Image, ImageChops, ImageOps, ImageStat
 import pytesseract
-from pdf2image import convert_from_bytes # Requer 'poppler-utils' no ambiente
 import io
 import os
 import re
 import json # Para processar a resposta da API
+import hashlib # Para indexar os resultados pelo conteúdo do arquivo
+import urllib.request # Para baixar os modelos 'tessdata_fast'
+import shutil
+import concurrent.futures # Para paralelizar o OCR das páginas
+import threading
+import itertools
+import math
+import tempfile
+import typing_extensions # TypedDict aceito pelo pydantic (google-generativeai) em Python < 3.12
+import functools
+import zlib # Hash estável das trigramas do cache semântico
 
-# Tenta importar a biblioteca do Google Gemini
+# Cada worker do pool de OCR executa o Tesseract em uma única thread: com N workers em N núcleos,
+# as até 4 threads OpenMP internas de cada execução só causariam disputa (N×4 threads em N núcleos).
+# Precisa ser definido antes de carregar a libtesseract (tesserocr) e é herdado pelos subprocessos do pytesseract.
+os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+
+# Tenta importar o tesserocr (binding C da libtesseract). Sem ele, o OCR usa o pytesseract,
+# que executa o binário 'tesseract' em um subprocesso a cada lote de páginas.
 try:
-    import google.generativeai as genai
-    import google.api_core.exceptions # Para capturar erros específicos da API
+    import tesserocr
 except ImportError:
-    st.error("Biblioteca 'google-generativeai' não encontrada. Instale-a com 'pip install google-generativeai' e adicione ao requirements.txt.")
-    # Adiciona um placeholder para evitar erros posteriores se a importação falhar
-    genai = None
-    google = None # Placeholder para api_core
+    tesserocr = None
+
+# Bibliotecas pesadas (pypdfium2, google-generativeai e numpy) são importadas apenas no primeiro uso:
+# o carregamento inicial do app não paga o custo de importação (centenas de ms) até que um PDF
+# seja processado ou a análise com o Gemini seja solicitada.
+@functools.lru_cache(maxsize=1)
+def _get_pdfium():
+    """
+    Importa o pypdfium2 (renderizador PDFium, no próprio processo e sem Poppler) no primeiro uso.
+    """
+    import pypdfium2
+    return pypdfium2
+
+
+# O PDFium não é thread-safe (nem entre documentos distintos): toda chamada a ele é serializada
+# por esta trava, já que as sessões do Streamlit rodam em threads concorrentes.
+_PDFIUM_LOCK = threading.Lock()
+
+
+@functools.lru_cache(maxsize=1)
+def _get_numpy():
+    """
+    Importa o numpy (usado apenas pelo cache semântico da análise) no primeiro uso.
+    """
+    import numpy
+    return numpy
+
+
+@functools.lru_cache(maxsize=1)
+def _get_genai():
+    """
+    Importa a biblioteca do Google Gemini no primeiro uso. Retorna None se ela não estiver instalada.
+    """
+    try:
+        import google.generativeai as genai
+    except ImportError:
+        return None
+    return genai
 
 # --- Configuração do Tesseract ---
-# (Mesma configuração de antes)
+# Os modelos 'tessdata_fast' usam uma LSTM menor com pesos inteiros (int8), bem mais rápida que os
+# modelos float instalados pelo pacote 'tesseract-ocr-por', com perda mínima de precisão em documentos
+# limpos como RG/CNH. O arquivo 'por.traineddata' é baixado na primeira execução para a pasta abaixo
+# (ignorada pelo git). Com ele presente, 'tesseract-ocr-por' no packages.txt é dispensável;
+# o pacote é mantido apenas como alternativa caso o download falhe.
+TESSDATA_FAST_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tessdata_fast")
+TESSDATA_FAST_URL = "https://github.com/tesseract-ocr/tessdata_fast/raw/main/por.traineddata"
+# Tempo máximo (s) de espera por dados do servidor durante o download dos modelos.
+TESSDATA_DOWNLOAD_TIMEOUT = 30
+
+
+@st.cache_resource
+def _download_tessdata_fast():
+    """
+    Garante que os modelos 'tessdata_fast' estejam disponíveis (baixando-os se necessário) e retorna
+    a pasta dos modelos. Falhas geram exceção, que o st.cache_resource não guarda: a próxima chamada
+    tenta o download de novo, em vez de desativar os modelos até o servidor reiniciar.
+    """
+    traineddata_path = os.path.join(TESSDATA_FAST_DIR, "por.traineddata")
+    if not os.path.isfile(traineddata_path):
+        os.makedirs(TESSDATA_FAST_DIR, exist_ok=True)
+        tmp_path = traineddata_path + ".tmp"
+        try:
+            # Timeout: uma conexão travada não pode bloquear o OCR (e as sessões que aguardam este cache)
+            with urllib.request.urlopen(TESSDATA_FAST_URL, timeout=TESSDATA_DOWNLOAD_TIMEOUT) as response, \
+                    open(tmp_path, "wb") as traineddata_file:
+                shutil.copyfileobj(response, traineddata_file, length=64 * 1024)
+            os.replace(tmp_path, traineddata_path)
+        except BaseException:
+            # Não deixa um download parcial para trás
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+    return TESSDATA_FAST_DIR
+
+
+def get_tessdata_fast_dir():
+    """
+    Retorna a pasta dos modelos 'tessdata_fast', ou None para usar os modelos do sistema
+    caso eles não possam ser obtidos.
+    """
+    try:
+        return _download_tessdata_fast()
+    except Exception as download_err:
+        st.warning(f"Não foi possível obter os modelos 'tessdata_fast' ({download_err}). Usando os modelos do sistema.")
+        return None
+
+
+# Parâmetros fixos do Tesseract (ver build_tesseract_config)
+_TESS_CONFIG = r'--oem 1 --psm 6 -l por'
+
+
+def build_tesseract_config(tessdata_dir):
+    """
+    Monta a configuração do pytesseract (somente LSTM, --oem 1), usando os modelos 'tessdata_fast'
+    quando disponíveis e os modelos do sistema caso contrário.
+    """
+    # Configuração Tesseract: --psm 6 assume um bloco de texto uniforme, o que dispensa a análise
+    # de layout por página em documentos de identidade. Para layouts variados, --psm 4 (coluna única)
+    # ou --psm 3 (segmentação automática) podem ser melhores, ao custo de mais processamento.
+    if tessdata_dir:
+        return f'--tessdata-dir "{tessdata_dir}" {_TESS_CONFIG}'
+    return _TESS_CONFIG
 # --- Fim da Configuração do Tesseract ---
 
+# --- Pool de threads para o OCR ---
+# Threads bastam para paralelizar o OCR: o pytesseract espera o subprocesso 'tesseract' e o tesserocr
+# libera o GIL durante o reconhecimento. Diferente de um pool de processos, não há fork do servidor
+# do Streamlit nem serialização (pickle) de páginas e exceções entre processos.
+_tesserocr_local = threading.local() # API do tesserocr de cada thread do pool (criada no initializer)
+
+
+def _tesserocr_init_kwargs(tessdata_dir):
+    """
+    Parâmetros da PyTessBaseAPI, os mesmos de build_tesseract_config (PSM 6, somente LSTM).
+    """
+    init_kwargs = {"lang": "por", "psm": tesserocr.PSM.SINGLE_BLOCK, "oem": tesserocr.OEM.LSTM_ONLY}
+    if tessdata_dir:
+        init_kwargs["path"] = tessdata_dir + os.sep
+    return init_kwargs
+
+
+def _init_tesserocr_worker(tessdata_dir):
+    """
+    Initializer das threads do pool: carrega o modelo LSTM uma única vez por thread.
+    """
+    _tesserocr_local.api = tesserocr.PyTessBaseAPI(**_tesserocr_init_kwargs(tessdata_dir))
+
+
+def _ocr_batch_tesserocr(page_paths):
+    """
+    Worker executado no pool de threads (tesserocr): realiza OCR de um lote de páginas
+    reutilizando a API já inicializada na thread, sem subprocesso nem recarga do modelo.
+    """
+    api = _tesserocr_local.api
+    page_texts = []
+    for page_path in page_paths:
+        api.SetImageFile(page_path)
+        page_texts.append(api.GetUTF8Text())
+    return page_texts
+
+
+def _ocr_batch_pytesseract(list_path, page_count, tesseract_config):
+    """
+    Worker executado no pool de threads (pytesseract): realiza OCR de um lote de páginas em uma
+    única execução do Tesseract (modo lista de arquivos), pagando a inicialização e a carga do modelo
+    uma só vez. Retorna o texto de cada página do lote, separado pelo form feed que o Tesseract
+    insere entre páginas.
+    """
+    text = pytesseract.image_to_string(list_path, config=tesseract_config)
+    page_texts = text.split('\f')[:page_count]
+    return page_texts + [""] * (page_count - len(page_texts))
+
+
+@st.cache_resource
+def get_ocr_pool(tessdata_dir):
+    """
+    Cria uma única vez (por servidor) o pool de threads usado no OCR, com uma thread por núcleo.
+    Com o tesserocr, cada thread inicializa sua própria API da libtesseract. A inicialização é testada
+    antes: se falhar (ex: modelo 'por' ausente), o initializer quebraria o pool em definitivo, então
+    o pool passa a usar o pytesseract. O atributo 'uses_tesserocr' indica o backend do pool.
+    """
+    if tesserocr is not None:
+        try:
+            tesserocr.PyTessBaseAPI(**_tesserocr_init_kwargs(tessdata_dir)).End()
+        except Exception as init_err:
+            st.warning(f"Não foi possível inicializar o tesserocr ({init_err}). Usando o pytesseract.")
+        else:
+            ocr_pool = concurrent.futures.ThreadPoolExecutor(
+                max_workers=os.cpu_count(), thread_name_prefix="ocr",
+                initializer=_init_tesserocr_worker, initargs=(tessdata_dir,))
+            ocr_pool.uses_tesserocr = True
+            return ocr_pool
+    ocr_pool = concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count(), thread_name_prefix="ocr")
+    ocr_pool.uses_tesserocr = False
+    return ocr_pool
+
+
+def _submit_ocr_batch(ocr_pool, page_numbers, page_paths, tesseract_config):
+    """
+    Envia um lote de páginas ao pool. No pytesseract, lotes com mais de uma página são passados como
+    uma lista de arquivos gravada ao lado das imagens; uma página isolada é passada diretamente.
+    'page_numbers' traz o número original de cada página do lote (usado nas mensagens de erro).
+    Retorna (números das páginas, caminhos das páginas, future).
+    """
+    try:
+        if ocr_pool.uses_tesserocr:
+            future = ocr_pool.submit(_ocr_batch_tesserocr, page_paths)
+        elif len(page_paths) == 1:
+            future = ocr_pool.submit(_ocr_batch_pytesseract, page_paths[0], 1, tesseract_config)
+        else:
+            list_path = os.path.join(os.path.dirname(page_paths[0]), f"batch_{page_numbers[0]:04d}.txt")
+            with open(list_path, "w", encoding="utf-8") as list_file:
+                list_file.write("\n".join(page_paths) + "\n")
+            future = ocr_pool.submit(_ocr_batch_pytesseract, list_path, len(page_paths), tesseract_config)
+    except concurrent.futures.BrokenExecutor as broken_err:
+        # Pool quebrado: o erro é entregue pelo future e tratado em _collect_ocr_result
+        future = concurrent.futures.Future()
+        future.set_exception(broken_err)
+    return page_numbers, page_paths, future
+
+
+def _report_ocr_error(page_number, ocr_err):
+    """
+    Exibe o erro de OCR de uma página (pelo seu número original no documento).
+    """
+    if isinstance(ocr_err, pytesseract.TesseractError):
+        st.error(f"Erro do Tesseract na imagem {page_number}: {ocr_err}")
+    else:
+        st.error(f"Erro inesperado durante o OCR na imagem {page_number}: {ocr_err}")
+
+
+def _collect_ocr_result(ocr_pool, page_numbers, page_paths, future, tesseract_config):
+    """
+    Aguarda o OCR de um lote e retorna a lista de textos, com None nas páginas que falharam.
+    Se um lote com várias páginas falhar, suas páginas são reprocessadas individualmente,
+    para que uma página problemática não invalide as demais.
+    A TesseractNotFoundError é propagada, pois inviabiliza o OCR de todas as páginas.
+    Se o pool estiver quebrado, ele é descartado do cache (o próximo OCR cria um novo) e as páginas
+    do lote ficam marcadas com erro, sem novas tentativas.
+    """
+    try:
+        return future.result()
+    except pytesseract.TesseractNotFoundError:
+        raise
+    except concurrent.futures.BrokenExecutor as broken_err:
+        get_ocr_pool.clear()
+        _report_ocr_error(page_numbers[0], broken_err)
+        return [None] * len(page_paths)
+    except Exception as batch_err:
+        if len(page_paths) == 1:
+            _report_ocr_error(page_numbers[0], batch_err)
+            return [None]
+        st.warning(f"Falha no OCR em lote das imagens {', '.join(map(str, page_numbers))} ({batch_err}). Reprocessando página a página...")
+
+    retries = [_submit_ocr_batch(ocr_pool, [page_number], [page_path], tesseract_config)
+               for page_number, page_path in zip(page_numbers, page_paths)]
+    page_texts = []
+    for single_page_numbers, single_page_paths, retry_future in retries:
+        page_texts.extend(_collect_ocr_result(ocr_pool, single_page_numbers, single_page_paths, retry_future, tesseract_config))
+    return page_texts
+# --- Fim do Pool de threads ---
+
+# --- Renderização de PDF ---
+# Resolução padrão usada para o OCR de PDFs (ajustável na barra lateral). O reconhecimento do Tesseract
+# em documentos limpos satura por volta de 200-250 DPI; acima disso os pixels extras só aumentam o custo
+# de OCR e memória. Digitalizações de baixa qualidade podem se beneficiar de valores maiores.
+OCR_DPI = 200
+
+
+# Tamanho máximo da pré-visualização, obtida reduzindo a primeira página já renderizada para o OCR.
+PREVIEW_MAX_SIZE = (800, 1200)
+
+
+def get_pdf_page_count(pdf_doc):
+    """
+    Número de páginas do documento. len() também chama o PDFium, então a leitura passa pela trava.
+    """
+    with _PDFIUM_LOCK:
+        return len(pdf_doc)
+
+
+def iter_pdf_pages(pdf_doc, dpi, start=0, page_count=None):
+    """
+    Renderiza as páginas de um documento PDFium uma a uma (gerador), como imagens PIL em tons de cinza,
+    a partir da página de índice 'start'. Cada página é liberada antes de a próxima ser renderizada.
+    'page_count' evita nova leitura do número de páginas quando o chamador já o conhece.
+    Renderizar direto em cinza (1 canal) reduz a memória a 1/3 e dispensa a conversão antes do OCR.
+    """
+    if page_count is None:
+        page_count = get_pdf_page_count(pdf_doc)
+    for page_index in range(start, page_count):
+        with _PDFIUM_LOCK:
+            page = pdf_doc[page_index]
+            try:
+                image = page.render(scale=dpi / 72, grayscale=True).to_pil()
+            finally:
+                page.close()
+        yield image
+
+
+@st.cache_resource(ttl=3600, max_entries=16)
+def get_pdf_document(file_bytes):
+    """
+    Abre (uma única vez por arquivo) o documento PDFium, compartilhado entre a pré-visualização e o OCR.
+    O documento é compartilhado: não o feche.
+    """
+    with _PDFIUM_LOCK:
+        return _get_pdfium().PdfDocument(file_bytes)
+
+
+# Média mínima de caracteres por página para considerar que o PDF já traz uma camada de texto
+# (PDF gerado digitalmente) e dispensar a renderização e o OCR.
+TEXT_LAYER_MIN_CHARS_PER_PAGE = 50
+
+
+def extract_pdf_text_layer(pdf_doc):
+    """
+    Extrai a camada de texto embutida de cada página do PDF (milissegundos, sem renderizar nada).
+    Retorna a lista de textos por página, ou None se o texto for escasso demais (PDF digitalizado),
+    caso em que o documento deve passar pelo OCR.
+    """
+    page_texts = []
+    with _PDFIUM_LOCK:
+        for page_index in range(len(pdf_doc)):
+            page = pdf_doc[page_index]
+            try:
+                text_page = page.get_textpage()
+                try:
+                    page_texts.append(text_page.get_text_range())
+                finally:
+                    text_page.close()
+            finally:
+                page.close()
+    if sum(len(text.strip()) for text in page_texts) <= TEXT_LAYER_MIN_CHARS_PER_PAGE * len(page_texts):
+        return None
+    return [text.strip() for text in page_texts]
+
+
+# Maior lado (px) das imagens enviadas: fotos de celular (ex: 4000x3000) são reduzidas a uma resolução
+# equivalente a ~300 DPI para um documento, onde o LSTM do Tesseract reconhece melhor e bem mais rápido.
+UPLOAD_MAX_SIDE = 2400
+
+
+@st.cache_resource(ttl=3600, max_entries=16)
+def get_uploaded_image(file_bytes):
+    """
+    Decodifica (uma única vez por arquivo) a imagem enviada, compartilhada entre a pré-visualização e o OCR.
+    Aplica a orientação EXIF (fotos de celular) e reduz imagens maiores que UPLOAD_MAX_SIDE.
+    A imagem é compartilhada: não a modifique.
+    """
+    image = Image.open(io.BytesIO(file_bytes))
+    image = ImageOps.exif_transpose(image) # Já retorna a imagem carregada (ou a original, sem EXIF)
+    image.load()
+    if max(image.size) > UPLOAD_MAX_SIDE:
+        image.thumbnail((UPLOAD_MAX_SIDE, UPLOAD_MAX_SIDE), Image.Resampling.LANCZOS)
+    return image
+
+
+# Poucas entradas: cada página em resolução de OCR ocupa até ~15 MB (400 DPI).
+@st.cache_resource(ttl=3600, max_entries=4)
+def get_pdf_first_page(file_bytes, dpi=OCR_DPI):
+    """
+    Renderiza (uma única vez por arquivo e resolução) a primeira página do PDF.
+    A pré-visualização é gerada na resolução escolhida para o OCR, então a mesma imagem serve aos dois,
+    evitando uma segunda renderização. Retorna None se o PDF não tiver páginas. A imagem é compartilhada: não a modifique.
+    """
+    return next(iter_pdf_pages(get_pdf_document(file_bytes), dpi=dpi), None)
+
+
+@st.cache_data(show_spinner=False, ttl=3600, max_entries=32)
+def render_preview(file_bytes, file_type, dpi=OCR_DPI):
+    """
+    Gera a imagem de pré-visualização: a própria imagem carregada ou a primeira página do PDF.
+    O cache é indexado pelo conteúdo do arquivo, então reruns do Streamlit não renderizam o PDF de novo.
+    A página é renderizada na resolução do OCR ('dpi'), para que o OCR reaproveite essa renderização.
+    """
+    if file_type in ['image/png', 'image/jpeg', 'image/jpg']:
+        return get_uploaded_image(file_bytes)
+    if file_type == 'application/pdf':
+        first_page = get_pdf_first_page(file_bytes, dpi)
+        if first_page is None:
+            return None
+        preview_image = first_page.copy()
+        preview_image.thumbnail(PREVIEW_MAX_SIZE)
+        return preview_image
+    return None
+# --- Fim da Renderização de PDF ---
+
+# --- Pré-processamento para OCR ---
+# Limiar de binarização (0-255) aplicado após o autocontraste.
+OCR_BINARIZE_THRESHOLD = 180
+
+
+def preprocess_for_ocr(image):
+    """
+    Converte a imagem para tons de cinza, aplica autocontraste e binariza (modo '1').
+    A LSTM do Tesseract processa imagens de 1 bit com bem menos trabalho que RGB de 24 bits,
+    e o fundo limpo costuma melhorar também a precisão.
+    """
+    # cutoff=2: ignora 2% dos extremos do histograma (reflexos, sujeira), esticando melhor o contraste
+    image = ImageOps.autocontrast(image if image.mode == 'L' else image.convert('L'), cutoff=2)
+    return image.point(lambda p: 255 if p > OCR_BINARIZE_THRESHOLD else 0, mode='1')
+
+
+# Páginas com desvio padrão de intensidade até este valor são praticamente uniformes (ex: verso em branco).
+BLANK_PAGE_MAX_STDDEV = 8.0
+# Grade da impressão digital (dHash) das páginas: (PAGE_HASH_SIZE+1) x PAGE_HASH_SIZE pixels.
+PAGE_HASH_SIZE = 16
+# Confirmação de página repetida: miniatura binarizada ainda legível, com esta largura (px), e fração
+# máxima de pixels diferentes. Páginas do mesmo modelo preenchidas com valores distintos diferem em
+# mais de 1% dos pixels; uma página repetida no arquivo difere apenas por ruído (bem menos de 0,1%).
+PAGE_COMPARE_WIDTH = 256
+PAGE_DUPLICATE_MAX_DIFF = 0.002
+
+
+def is_blank_page(image):
+    """
+    Indica se a página é praticamente uniforme (em branco), dispensando o OCR.
+    """
+    return ImageStat.Stat(image if image.mode == 'L' else image.convert('L')).stddev[0] <= BLANK_PAGE_MAX_STDDEV
+
+
+def page_fingerprint(image):
+    """
+    Impressão digital perceptual (dHash) da página: compara cada pixel de uma miniatura com o vizinho à
+    direita. Serve apenas de pré-filtro: páginas do mesmo modelo (ex: formulários de pessoas diferentes)
+    também colidem; a repetição é confirmada por is_same_page.
+    """
+    small = image.convert('L').resize((PAGE_HASH_SIZE + 1, PAGE_HASH_SIZE), Image.Resampling.BILINEAR)
+    pixels = small.tobytes()
+    row_size = PAGE_HASH_SIZE + 1
+    return bytes(
+        pixels[row * row_size + col] > pixels[row * row_size + col + 1]
+        for row in range(PAGE_HASH_SIZE) for col in range(PAGE_HASH_SIZE)
+    )
+
+
+def page_comparison_image(image):
+    """
+    Miniatura binarizada (0/255) da página com PAGE_COMPARE_WIDTH px de largura, em que os valores
+    preenchidos ainda se distinguem. Usada para confirmar páginas repetidas.
+    """
+    gray = image if image.mode == 'L' else image.convert('L')
+    height = max(1, round(gray.height * PAGE_COMPARE_WIDTH / gray.width))
+    small = ImageOps.autocontrast(gray.resize((PAGE_COMPARE_WIDTH, height), Image.Resampling.BOX))
+    return small.point(lambda p: 255 if p > OCR_BINARIZE_THRESHOLD else 0)
+
+
+def is_same_page(comparison_image, other_comparison_image):
+    """
+    Confirma que duas páginas (miniaturas de page_comparison_image) são a mesma: no máximo
+    PAGE_DUPLICATE_MAX_DIFF dos pixels diferem.
+    """
+    if comparison_image.size != other_comparison_image.size:
+        return False
+    differing_pixels = ImageChops.difference(comparison_image, other_comparison_image).histogram()[255]
+    return differing_pixels <= PAGE_DUPLICATE_MAX_DIFF * comparison_image.width * comparison_image.height
+# --- Fim do Pré-processamento para OCR ---
+
+def _join_page_texts(page_texts, page_numbers=None):
+    """
+    Monta o texto final do documento a partir dos textos por página, com o cabeçalho '--- Página N ---'
+    em documentos com várias páginas. Páginas que falharam (text None) recebem o marcador de erro.
+    'page_numbers' traz o número original de cada página quando algumas foram descartadas (padrão: 1..N).
+    O texto é escrito em um único buffer (StringIO), sem strings intermediárias por página.
+    """
+    multi_page = len(page_texts) > 1
+    if page_numbers is None:
+        page_numbers = range(1, len(page_texts) + 1)
+    buffer = io.StringIO()
+    for page_number, text in zip(page_numbers, page_texts):
+        if text is None:
+            buffer.write(f"--- Página {page_number}: Erro no OCR ---")
+        else:
+            if multi_page:
+                buffer.write(f"--- Página {page_number} ---\n")
+            buffer.write(text)
+        buffer.write("\n\n")
+    return buffer.getvalue().strip()
+
+
 # 2. Função para realizar OCR (sem alterações significativas)
-def perform_ocr(file_bytes, file_type):
+@st.cache_data(show_spinner=False, ttl=3600, max_entries=32)
+def perform_ocr(file_bytes, file_type, ocr_dpi=OCR_DPI):
     """
-    Realiza OCR nos bytes de uma imagem ou PDF.
+    Realiza OCR nos bytes de uma imagem ou PDF (PDFs renderizados em 'ocr_dpi').
     (Função original com pequenas melhorias no tratamento de erro)
+    O resultado é cacheado pelo conteúdo do arquivo: repetir o OCR do mesmo documento é O(1).
+    Retorna apenas o texto (ou None em caso de falha): imagens no valor de retorno seriam serializadas
+    a cada gravação e leitura do cache, e a pré-visualização tem seu próprio cache.
     """
     # ... (código da função perform_ocr como na v1.3) ...
     extracted_text = ""
-    display_image = None
-    images_to_process = []
+    pages = []
+    page_total = 0
 
     try:
         # Processa imagens PNG ou JPEG
         if file_type in ['image/png', 'image/jpeg', 'image/jpg']:
-            image = Image.open(io.BytesIO(file_bytes))
-            # Converte para RGB para evitar potenciais problemas com Tesseract
-            if image.mode == 'RGBA':
-                 image = image.convert('RGB')
-            elif image.mode == 'P': # Paleta
-                 image = image.convert('RGB')
-            elif image.mode == 'L': # Grayscale
-                 image = image.convert('RGB') # Tesseract geralmente prefere RGB ou Grayscale
-
-            images_to_process.append(image)
-            display_image = image
+            image = get_uploaded_image(file_bytes)
+            # Converte para tons de cinza (1 canal): o Tesseract trabalha em cinza de qualquer forma,
+            # e RGB triplicaria os dados copiados até ele
+            if image.mode != 'L':
+                 image = image.convert('L')
+
+            pages = [image]
+            page_total = 1
 
         # Processa arquivos PDF
         elif file_type == 'application/pdf':
-            st.info("Convertendo PDF para imagens...")
             try:
-                # Usa poppler_path se necessário em ambientes específicos (geralmente não no Cloud com packages.txt)
-                # poppler_path = None # Defina se necessário
-                pdf_images = convert_from_bytes(file_bytes, dpi=300)#, poppler_path=poppler_path)
-                if pdf_images:
-                    images_to_process.extend(pdf_images)
-                    display_image = pdf_images[0]
-                else:
-                    st.warning("Não foi possível extrair imagens do PDF (pdf2image retornou lista vazia).")
-                    return None, None
+                pdf_doc = get_pdf_document(file_bytes)
             except Exception as pdf_err:
-                 if 'poppler' in str(pdf_err).lower() or 'unable to get page count' in str(pdf_err).lower():
-                      st.error("Erro ao converter PDF: Dependência 'poppler' não encontrada ou não está no PATH.")
-                      st.info("Verifique a instalação do 'poppler-utils' (via packages.txt no Streamlit Cloud).")
-                 else:
-                      st.error(f"Erro inesperado ao converter PDF: {pdf_err}")
-                 return None, None
+                 st.error(f"Erro inesperado ao abrir o PDF: {pdf_err}")
+                 return None
+            page_total = get_pdf_page_count(pdf_doc)
+            if page_total == 0:
+                st.warning("Não foi possível extrair imagens do PDF (o documento não possui páginas).")
+                return None
+            # PDF gerado digitalmente: o texto embutido dispensa a renderização e o OCR.
+            page_texts = extract_pdf_text_layer(pdf_doc)
+            if page_texts is not None:
+                st.info("O PDF já possui camada de texto; OCR dispensado.")
+                return _join_page_texts(page_texts)
+            st.info("Convertendo PDF para imagens...")
+            # Gerador: o OCR da página 1 começa antes de a página N ser renderizada.
+            # A página 1 reaproveita a renderização feita para a pré-visualização.
+            pages = itertools.chain([get_pdf_first_page(file_bytes, ocr_dpi)], iter_pdf_pages(pdf_doc, dpi=ocr_dpi, start=1, page_count=page_total))
         else:
             st.error(f"Tipo de arquivo não suportado: {file_type}")
-            return None, None
-
-        if not images_to_process:
-             st.warning("Nenhuma imagem encontrada ou extraída.")
-             return display_image, ""
-
-        # Realiza OCR
-        st.info(f"Realizando OCR em {len(images_to_process)} imagem(ns)...")
-        full_text_list = []
-        for i, img in enumerate(images_to_process):
-             try:
-                 # Configuração Tesseract: --psm 6 assume um bloco de texto uniforme.
-                 # Para documentos com layout variado, --psm 3 (Auto Page Segmentation) ou --psm 4 (Assume single column) podem ser melhores. Testar!
-                 custom_config = r'--oem 3 --psm 4 -l por' # Tentando PSM 4
-                 text = pytesseract.image_to_string(img, config=custom_config)
-                 if len(images_to_process) > 1:
-                     full_text_list.append(f"--- Página {i+1} ---\n{text}")
-                 else:
-                     full_text_list.append(text)
-             except pytesseract.TesseractNotFoundError:
-                  st.error("Erro Crítico: Tesseract não encontrado. Verifique a instalação e o PATH.")
-                  return None, None
-             except pytesseract.TesseractError as tess_err:
-                 st.error(f"Erro do Tesseract na imagem {i+1}: {tess_err}")
-                 full_text_list.append(f"--- Página {i+1}: Erro no OCR ---")
-             except Exception as ocr_err:
-                 st.error(f"Erro inesperado durante o OCR na imagem {i+1}: {ocr_err}")
-                 full_text_list.append(f"--- Página {i+1}: Erro no OCR ---")
-
-        extracted_text = "\n\n".join(full_text_list)
-        return display_image, extracted_text.strip()
+            return None
+
+        # Realiza OCR: as páginas são gravadas em disco à medida que são renderizadas e agrupadas em
+        # lotes (um por thread do pool), cada lote processado por uma única execução do Tesseract.
+        st.info(f"Realizando OCR em {page_total} imagem(ns)...")
+        tessdata_dir = get_tessdata_fast_dir()
+        tesseract_config = build_tesseract_config(tessdata_dir)
+        ocr_pool = get_ocr_pool(tessdata_dir)
+        pages_per_batch = max(1, math.ceil(page_total / (os.cpu_count() or 1)))
+        page_texts = []
+        page_numbers = [] # Número original de cada página enviada ao OCR
+        seen_pages = {} # Impressão digital -> miniaturas de comparação das páginas já enviadas ao OCR
+        skipped_blank = skipped_duplicate = 0
+        with tempfile.TemporaryDirectory(prefix="ocr_") as tmp_dir:
+            pending = [] # (números das páginas, caminhos das páginas, future), em ordem
+            batch_paths = []
+            batch_numbers = []
+            for page_index, page in enumerate(pages):
+                # Páginas em branco ou repetidas (mesmo documento digitalizado duas vezes) não passam pelo OCR
+                if is_blank_page(page):
+                    skipped_blank += 1
+                    continue
+                # dHash como pré-filtro barato; a repetição só é aceita após comparar os pixels
+                fingerprint = page_fingerprint(page)
+                comparison_image = page_comparison_image(page)
+                same_fingerprint_pages = seen_pages.setdefault(fingerprint, [])
+                if any(is_same_page(comparison_image, seen_page) for seen_page in same_fingerprint_pages):
+                    skipped_duplicate += 1
+                    continue
+                same_fingerprint_pages.append(comparison_image)
+                page_numbers.append(page_index + 1)
+                batch_numbers.append(page_index + 1)
+                page_path = os.path.join(tmp_dir, f"page_{page_index:04d}.png")
+                # Arquivo descartável: compressão mínima, priorizando a velocidade de gravação
+                preprocess_for_ocr(page).save(page_path, format='PNG', compress_level=1)
+                batch_paths.append(page_path)
+                del page
+                if len(batch_paths) == pages_per_batch:
+                    pending.append(_submit_ocr_batch(ocr_pool, batch_numbers, batch_paths, tesseract_config))
+                    batch_paths = []
+                    batch_numbers = []
+            if batch_paths:
+                pending.append(_submit_ocr_batch(ocr_pool, batch_numbers, batch_paths, tesseract_config))
+            for batch_page_numbers, page_paths, future in pending:
+                page_texts.extend(_collect_ocr_result(ocr_pool, batch_page_numbers, page_paths, future, tesseract_config))
+
+        if skipped_blank or skipped_duplicate:
+            st.info(f"Páginas ignoradas no OCR: {skipped_blank} em branco, {skipped_duplicate} repetida(s).")
+
+        if not page_texts:
+             st.warning("Nenhuma imagem com conteúdo encontrada ou extraída.")
+             return ""
+
+        extracted_text = _join_page_texts(page_texts, page_numbers)
+        return extracted_text
 
     # Tratamento de erros gerais
     except ImportError as import_err:
-        if 'pdf2image' in str(import_err) or 'poppler' in str(import_err):
-             st.error("Erro: A biblioteca 'pdf2image' ou sua dependência 'poppler' não foi encontrada.")
-             st.info("Para rodar localmente, instale o Poppler. Para deploy no Streamlit Cloud, adicione 'poppler-utils' ao seu 'packages.txt'.")
-        else:
-             st.error(f"Erro de importação não relacionado ao pdf2image: {import_err}")
-        return None, None
+        st.error(f"Erro de importação durante o OCR: {import_err}")
+        return None
     except pytesseract.TesseractNotFoundError:
         st.error("Erro Crítico: O executável do Tesseract OCR não foi encontrado.")
         st.info("Verifique a instalação do Tesseract e se ele está no PATH do sistema.")
-        return None, None
+        return None
     except Exception as e:
         st.error(f"Ocorreu um erro inesperado durante o processamento OCR: {e}")
-        return display_image if 'display_image' in locals() else None, None
+        return None
+
+
+# --- Modelo Gemini ---
+# Usando um modelo mais recente ou 'gemini-pro' como alternativa estável
+GEMINI_MODEL_NAME = "gemini-1.5-flash-latest"
+# GEMINI_MODEL_NAME = "gemini-pro" # Alternativa
+
+
+# Campos extraídos do documento e suas descrições no prompt (na ordem de exibição).
+DOCUMENT_FIELD_DESCRIPTIONS = {
+    "nome": "Nome completo",
+    "data_nascimento": "Formato DD/MM/AAAA",
+    "local_nascimento": "Cidade e UF, ex: Goiânia-GO",
+    "doc_identidade": "Número do RG ou CNH",
+    "orgao_emissor": "Órgão emissor do documento, ex: SSP/GO",
+    "cpf": "Número do CPF, formato XXX.XXX.XXX-XX",
+    "nacionalidade": "ex: Brasileira",
+    "num_registro": "Número de registro do documento, pode ser igual ao doc_identidade ou um campo separado",
+    "filiacao_mae": "Nome completo da mãe",
+    "filiacao_pai": "Nome completo do pai",
+}
+
+
+# Instruções fixas, enviadas como system_instruction: idênticas em todas as chamadas, formam um
+# prefixo estável (aproveitado pelo cache implícito do Gemini) e não são repetidas no prompt.
+GEMINI_SYSTEM_INSTRUCTION = (
+    "Analise o texto extraído de um documento de identidade brasileiro (como RG ou CNH) "
+    "e retorne as informações estruturadas estritamente em formato JSON. Campos possíveis:\n"
+    + "\n".join(f"- {field} ({description})" for field, description in DOCUMENT_FIELD_DESCRIPTIONS.items())
+    + "\nProcure apenas os campos indicados em cada solicitação. "
+    "Se um campo não for encontrado, omita a chave correspondente no JSON. "
+    "Responda APENAS com o objeto JSON, sem nenhum texto adicional antes ou depois."
+)
+# Limite da resposta: o JSON com os 10 campos cabe com folga em 512 tokens.
+GEMINI_MAX_OUTPUT_TOKENS = 512
+
+
+class DocumentoIdentidade(typing_extensions.TypedDict, total=False):
+    """
+    Esquema da resposta do Gemini (modo JSON nativo). Todos os campos são opcionais:
+    campos não encontrados no documento são omitidos pelo modelo.
+    """
+    nome: str
+    data_nascimento: str
+    local_nascimento: str
+    doc_identidade: str
+    orgao_emissor: str
+    cpf: str
+    nacionalidade: str
+    num_registro: str
+    filiacao_mae: str
+    filiacao_pai: str
+
+
+# Serializa genai.configure() (estado global da biblioteca) e a criação do cliente de cada modelo.
+_GENAI_CONFIGURE_LOCK = threading.Lock()
+
+
+@st.cache_resource
+def get_gemini_model(api_key, model_name=GEMINI_MODEL_NAME):
+    """
+    Configura a API e cria o GenerativeModel uma única vez por (API Key, modelo), reaproveitando
+    o cliente (e suas conexões) entre chamadas e reruns do Streamlit.
+    O modelo responde em JSON nativo conforme o esquema DocumentoIdentidade,
+    dispensando a limpeza de blocos markdown na resposta. As instruções fixas vão no system_instruction.
+    """
+    genai = _get_genai()
+    generation_config = genai.GenerationConfig(
+        temperature=0,
+        max_output_tokens=GEMINI_MAX_OUTPUT_TOKENS,
+        response_mime_type="application/json",
+        response_schema=DocumentoIdentidade,
+    )
+    model = genai.GenerativeModel(
+        model_name,
+        generation_config=generation_config,
+        system_instruction=GEMINI_SYSTEM_INSTRUCTION,
+    )
+    # genai.configure() altera uma configuração global, e o GenerativeModel só obteria seu cliente na
+    # primeira chamada: outra sessão poderia ter configurado outra API Key nesse intervalo. O cliente
+    # é criado e vinculado ao modelo aqui, sob a trava, com a API Key deste modelo.
+    from google.generativeai import client as genai_client
+    with _GENAI_CONFIGURE_LOCK:
+        genai.configure(api_key=api_key)
+        model._client = genai_client.get_default_generative_client()
+    return model
+# --- Fim do Modelo Gemini ---
+
+# --- Redução do texto enviado ao Gemini ---
+# Acima deste tamanho, apenas as linhas com indícios dos campos procurados são enviadas.
+GEMINI_MAX_INPUT_CHARS = 4000
+# Linhas de contexto mantidas antes e depois de cada linha relevante.
+GEMINI_CONTEXT_LINES = 2
+
+# Expressões regulares compiladas uma única vez, fora do caminho de cada análise
+_WHITESPACE_RUN = re.compile(r'\s+')
+_FIELD_HINT = re.compile(
+    r'\d{3}\.\d{3}\.\d{3}-\d{2}|\b\d{2}/\d{2}/\d{4}\b|\bSSP\s*[/-]\s*[A-Z]{2}\b'
+    r'|\b(?:NOME|FILIA[ÇC][ÃA]O|NASCIMENTO|NATURALIDADE|NACIONALIDADE|REGISTRO|IDENTIDADE|RG|CPF|[ÓO]RG[ÃA]O|EMISSOR|PAI|M[ÃA]E)\b',
+    re.IGNORECASE)
+_CPF = re.compile(r'\b\d{3}\.\d{3}\.\d{3}-\d{2}\b')
+_BIRTH_DATE = re.compile(r'NASC(?:IMENTO)?\D{0,40}?(\d{2}/\d{2}/\d{4})', re.IGNORECASE)
+_ISSUING_AGENCY = re.compile(r'\b(SSP|SESP|SDS|DETRAN|IFP|IIRGD)\s*[/-]\s*([A-Z]{2})\b')
+# Padrões mínimos de um documento de identidade (CPF, número de RG, órgão emissor): se nenhum
+# aparece no texto, a análise com o Gemini retornaria apenas campos vazios e não é feita.
+_DOC_PATTERNS = [
+    re.compile(r'\d{3}\.?\d{3}\.?\d{3}-?\d{2}'),
+    re.compile(r'\b\d{1,3}\.?\d{3}\.?\d{3}-?[\dXx]\b'),
+    re.compile(r'\b(?:SSP|DETRAN|IFP|IIRGD)\b', re.IGNORECASE),
+]
+
+
+def reduce_text_for_ai(text):
+    """
+    Reduz o texto OCR antes de enviá-lo ao Gemini: normaliza os espaços, remove linhas vazias e,
+    em textos longos, mantém apenas as linhas com indícios dos campos procurados (CPF, datas,
+    órgão emissor, rótulos como NOME ou FILIAÇÃO) e suas linhas vizinhas.
+    Menos tokens de entrada reduzem a latência e o custo da chamada.
+    """
+    lines = [_WHITESPACE_RUN.sub(' ', line).strip() for line in text.splitlines()]
+    lines = [line for line in lines if line]
+    reduced_text = "\n".join(lines)
+    if len(reduced_text) <= GEMINI_MAX_INPUT_CHARS:
+        return reduced_text
+
+    kept_indexes = set()
+    for i, line in enumerate(lines):
+        if _FIELD_HINT.search(line):
+            kept_indexes.update(range(max(0, i - GEMINI_CONTEXT_LINES), min(len(lines), i + GEMINI_CONTEXT_LINES + 1)))
+    if not kept_indexes:
+        return reduced_text[:GEMINI_MAX_INPUT_CHARS]
+    return "\n".join(lines[i] for i in sorted(kept_indexes))
+# --- Fim da Redução do texto ---
+
+def strip_json_fence(text):
+    """
+    Remove um eventual bloco markdown (```json ... ```) em volta do JSON, sem expressões regulares.
+    Com o esquema de resposta o modelo não o emite; é apenas uma salvaguarda (no caso comum, custo nulo).
+    """
+    text = text.strip()
+    if not text.startswith('```'):
+        return text
+    return text.removeprefix('```json').removeprefix('```').strip().removesuffix('```').strip()
+
+
+# --- Extração local de campos com formato fixo ---
+def looks_like_identity_document(text):
+    """
+    Verificação estrutural barata antes da chamada à API: o texto contém ao menos um padrão de CPF,
+    número de RG ou órgão emissor?
+    """
+    return any(pattern.search(text) for pattern in _DOC_PATTERNS)
+
+
+def regex_extract(text):
+    """
+    Extrai localmente, por expressões regulares, os campos de formato fixo que dispensam o Gemini:
+    CPF, data de nascimento (a data logo após o rótulo de nascimento) e órgão emissor (ex: SSP/GO).
+    Retorna apenas os campos encontrados.
+    """
+    found = {}
+    cpf_match = _CPF.search(text)
+    if cpf_match:
+        found["cpf"] = cpf_match.group()
+    # Documentos trazem outras datas (expedição, validade): só a data após o rótulo é confiável
+    birth_match = _BIRTH_DATE.search(text)
+    if birth_match:
+        found["data_nascimento"] = birth_match.group(1)
+    issuer_match = _ISSUING_AGENCY.search(text)
+    if issuer_match:
+        found["orgao_emissor"] = f"{issuer_match.group(1)}/{issuer_match.group(2)}"
+    return found
+# --- Fim da Extração local ---
+
+def normalize_text(text):
+    """
+    Normaliza o texto OCR para comparação: sequências de espaços/quebras de linha viram um único espaço.
+    """
+    return _WHITESPACE_RUN.sub(' ', text).strip()
+
+
+# --- Cache semântico (textos OCR quase idênticos) ---
+# Duas digitalizações do mesmo documento diferem por alguns caracteres mal reconhecidos, o que basta
+# para errar o cache exato. Cada texto é representado por um vetor de trigramas de caracteres
+# (hash em SEMANTIC_CACHE_DIM posições, normalizado), comparado por similaridade de cosseno.
+SEMANTIC_CACHE_DIM = 4096
+SEMANTIC_CACHE_THRESHOLD = 0.95
+# Textos curtos demais têm poucas trigramas: a similaridade deixa de ser confiável.
+SEMANTIC_CACHE_MIN_CHARS = 200
+SEMANTIC_CACHE_MAX_ENTRIES = 64
+
+
+def embed_text(normalized_text):
+    """
+    Vetor de trigramas de caracteres do texto (normalizado para norma 1).
+    """
+    np = _get_numpy()
+    lowered = normalized_text.lower()
+    indices = [zlib.crc32(lowered[i:i + 3].encode('utf-8')) % SEMANTIC_CACHE_DIM for i in range(len(lowered) - 2)]
+    vector = np.bincount(indices, minlength=SEMANTIC_CACHE_DIM).astype(np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+def _get_semantic_cache():
+    """
+    Cache semântico da sessão: matriz de vetores (uma linha por texto) e entradas (campos locais, resultado).
+    """
+    np = _get_numpy()
+    if "semantic_cache" not in st.session_state:
+        st.session_state.semantic_cache = {"embeddings": np.empty((0, SEMANTIC_CACHE_DIM), dtype=np.float32), "entries": []}
+    return st.session_state.semantic_cache
+
+
+def lookup_semantic_cache(embedding, local_data):
+    """
+    Procura um resultado já obtido para um texto semelhante (similaridade acima de SEMANTIC_CACHE_THRESHOLD).
+    Os campos extraídos localmente (CPF, data de nascimento...) precisam coincidir, para que documentos de
+    mesmo modelo mas de pessoas diferentes nunca compartilhem o resultado. Retorna None se não houver.
+    """
+    np = _get_numpy()
+    cache = _get_semantic_cache()
+    if not cache["entries"]:
+        return None
+    similarities = cache["embeddings"] @ embedding # Uma única multiplicação para todas as entradas
+    best_index = int(np.argmax(similarities))
+    cached_local_data, cached_result = cache["entries"][best_index]
+    if similarities[best_index] <= SEMANTIC_CACHE_THRESHOLD or cached_local_data != local_data:
+        return None
+    return dict(cached_result)
 
 
+def store_semantic_cache(embedding, local_data, result):
+    """
+    Guarda o resultado de uma análise no cache semântico, descartando as entradas mais antigas.
+    """
+    np = _get_numpy()
+    cache = _get_semantic_cache()
+    cache["embeddings"] = np.vstack([cache["embeddings"], embedding])[-SEMANTIC_CACHE_MAX_ENTRIES:]
+    cache["entries"] = (cache["entries"] + [(local_data, dict(result))])[-SEMANTIC_CACHE_MAX_ENTRIES:]
+# --- Fim do Cache semântico ---
+
 # 3. Função para Análise Estruturada com API Gemini (Usando configure/GenerativeModel)
+def analysis_cache_key(text):
+    """
+    Chave do cache da análise: hash SHA-256 do texto OCR com os espaços normalizados, de modo que
+    diferenças apenas de espaçamento/quebras de linha reaproveitem o resultado já obtido.
+    """
+    return hashlib.sha256(normalize_text(text).encode('utf-8')).hexdigest()
+
+
 def analyze_text_with_ai(text, api_key):
     """
     Analisa o texto OCR usando a API do Google Gemini para extrair dados,
     utilizando genai.configure() e genai.GenerativeModel().
     (Função como na v1.3)
+    Valida as entradas e consulta o cache (indexado pelo texto normalizado e pelo modelo, nunca
+    pela API Key), evitando chamadas repetidas à API para o mesmo documento.
     """
-    # ... (código da função analyze_text_with_ai como na v1.3) ...
-    if not genai or not google:
+    if _get_genai() is None:
+        st.error("Biblioteca 'google-generativeai' não encontrada. Instale-a com 'pip install google-generativeai' e adicione ao requirements.txt.")
         return {"Erro": "Biblioteca 'google-generativeai' não está instalada ou não pôde ser importada."}
 
     if not api_key:
@@ -144,76 +883,111 @@ def analyze_text_with_ai(text, api_key):
     if not text or not isinstance(text, str) or len(text.strip()) < 10:
         return {"Erro": "Texto de entrada inválido ou muito curto para análise."}
 
-    # --- Configura a API ---
+    # O OCR funcionou, mas o texto não parece um documento de identidade: não gasta uma chamada à API
+    if not looks_like_identity_document(text):
+        return {"Aviso": "Texto não aparenta ser um documento de identidade (nenhum padrão CPF/RG/órgão emissor detectado). Análise não realizada."}
+
+    # Texto quase idêntico a um já analisado nesta sessão: reaproveita o resultado sem chamar a API
+    normalized_text = normalize_text(text)
+    embedding = None
+    if len(normalized_text) >= SEMANTIC_CACHE_MIN_CHARS:
+        embedding = embed_text(normalized_text)
+        local_data = regex_extract(text)
+        cached_result = lookup_semantic_cache(embedding, local_data)
+        if cached_result is not None:
+            st.info("Resultado reaproveitado de um documento praticamente idêntico já analisado.")
+            return cached_result
+
+    result = _analyze_text_cached(analysis_cache_key(text), GEMINI_MODEL_NAME, text, api_key)
+    if embedding is not None and isinstance(result, dict) and "Erro" not in result:
+        store_semantic_cache(embedding, local_data, result)
+    return result
+
+
+def clear_cached_analysis(text):
+    """
+    Remove do cache a análise do texto informado (usado quando a análise falha).
+    """
+    _analyze_text_cached.clear(analysis_cache_key(text), GEMINI_MODEL_NAME)
+
+
+# Persistido em disco: o cache sobrevive a reinícios do app. Parâmetros com '_' ficam fora da chave.
+@st.cache_data(show_spinner=False, max_entries=128, persist="disk")
+def _analyze_text_cached(text_key, model_name, _text, _api_key):
+    """
+    Executa a análise com o Gemini. Cacheado por (hash do texto normalizado, modelo).
+    """
+    # ... (código da função analyze_text_with_ai como na v1.3) ...
+    import google.api_core.exceptions # Dependência do google-generativeai (já carregada com ele); usado no tratamento de erros abaixo
+    text, api_key = _text, _api_key
+
+    # --- Extrai localmente os campos de formato fixo; o Gemini só procura os demais ---
+    local_data = regex_extract(text)
+    missing_fields = [field for field in DOCUMENT_FIELD_DESCRIPTIONS if field not in local_data]
+
+    # --- Reduz o texto antes de montar o prompt ---
+    text = reduce_text_for_ai(text)
+
+    # --- Obtém o modelo (API configurada uma única vez por API Key) ---
     try:
-        genai.configure(api_key=api_key)
+        model = get_gemini_model(api_key, model_name)
     except Exception as config_err:
         st.error(f"Erro ao configurar a API Gemini: {config_err}")
         return {"Erro": f"Falha ao configurar API Gemini: {config_err}"}
 
     # --- Prompt para o LLM ---
-    prompt = f"""
-    Analise o seguinte texto extraído de um documento de identidade brasileiro (como RG ou CNH)
-    e retorne as informações estruturadas **estritamente em formato JSON**. Procure pelos seguintes campos:
-    - nome (Nome completo)
-    - data_nascimento (Formato DD/MM/AAAA)
-    - local_nascimento (Cidade e UF, ex: Goiânia-GO)
-    - doc_identidade (Número do RG ou CNH)
-    - orgao_emissor (Órgão emissor do documento, ex: SSP/GO)
-    - cpf (Número do CPF, formato XXX.XXX.XXX-XX)
-    - nacionalidade (ex: Brasileira)
-    - num_registro (Número de registro do documento, pode ser igual ao doc_identidade ou um campo separado)
-    - filiacao_mae (Nome completo da mãe)
-    - filiacao_pai (Nome completo do pai)
-
-    Se um campo não for encontrado, retorne null ou omita a chave correspondente no JSON.
-    **Responda APENAS com o objeto JSON, sem nenhum texto adicional antes ou depois.**
-
-    Texto para análise:
-    ---
-    {text}
-    ---
-
-    JSON esperado:
-    """
-
-    # --- Define o nome do modelo ---
-    # Usando um modelo mais recente ou 'gemini-pro' como alternativa estável
-    model_name = "gemini-1.5-flash-latest"
-    # model_name = "gemini-pro" # Alternativa
+    # Só a parte variável vai no prompt; as instruções fixas estão em GEMINI_SYSTEM_INSTRUCTION
+    prompt = f"Campos a procurar: {', '.join(missing_fields)}\nTexto:\n---\n{text}\n---\nJSON:"
 
     # --- Chama a API usando GenerativeModel ---
     try:
-        st.info(f"Enviando solicitação para a API Gemini (modelo: {model_name})...")
-        # Cria a instância do modelo AQUI, após configurar a API Key
-        model = genai.GenerativeModel(model_name)
         # Adicionando um timeout simples para a chamada da API (ex: 60 segundos)
         # Nota: O timeout real pode depender da implementação da biblioteca
-        response = model.generate_content(prompt)#, request_options={'timeout': 60}) # Timeout pode não ser suportado diretamente assim
-        st.info("Resposta recebida da API Gemini.")
+        # Streaming: o JSON é exibido à medida que é gerado, em vez de aguardar a resposta completa
+        # O esquema da resposta contém apenas os campos ainda não extraídos localmente
+        response_schema = typing_extensions.TypedDict("DocumentoIdentidadeParcial", {field: str for field in missing_fields}, total=False)
+        response = model.generate_content(prompt, stream=True, generation_config={"response_schema": response_schema})#, request_options={'timeout': 60}) # Timeout pode não ser suportado diretamente assim
+        live_placeholder = st.empty()
+        response_chunks = []
+        for chunk in response:
+            if not chunk.parts:
+                continue
+            response_chunks.append(chunk.text)
+            partial_text = "".join(response_chunks)
+            # Só tenta decodificar quando o trecho termina em '}': o objeto pode estar completo
+            if not partial_text.rstrip().endswith('}'):
+                live_placeholder.code(partial_text, language="json")
+                continue
+            try:
+                live_placeholder.json(json.loads(partial_text))
+            except json.JSONDecodeError:
+                live_placeholder.code(partial_text, language="json")
+                continue
+            # Objeto JSON completo: não espera o fim do stream
+            break
+        live_placeholder.empty()
 
         # Extrai a resposta como texto
-        response_text = ""
-        if hasattr(response, 'text'):
-             response_text = response.text
-        elif response.candidates and response.candidates[0].content and response.candidates[0].content.parts:
-             response_text = response.candidates[0].content.parts[0].text
-        else:
+        response_text = "".join(response_chunks)
+        if not response_text:
              st.warning("Estrutura de resposta da API Gemini inesperada.")
-             try:
-                 st.json(response)
-             except:
-                 st.text(str(response))
+             # Diagnóstico curto por acesso direto aos atributos, sem serializar a resposta inteira
+             candidates = getattr(response, 'candidates', None)
+             finish_reason = candidates[0].finish_reason if candidates else 'none'
+             st.caption(f"finish_reason={finish_reason}, feedback={getattr(response, 'prompt_feedback', None)}")
              return {"Erro": "Estrutura de resposta da API inesperada."}
 
-        # Limpa formatação markdown se presente
-        response_text = re.sub(r'^```json\s*', '', response_text.strip(), flags=re.IGNORECASE)
-        response_text = re.sub(r'\s*```$', '', response_text.strip())
+        # O esquema garante um objeto JSON válido; a remoção de bloco markdown é só uma salvaguarda
+        extracted_data = json.loads(strip_json_fence(response_text))
+        if not isinstance(extracted_data, dict):
+            return extracted_data
 
-        # Tenta decodificar o JSON
-        extracted_data = json.loads(response_text)
-        return extracted_data
+        # Junta os campos extraídos localmente (que têm precedência) e devolve todos os campos do
+        # esquema, na ordem de exibição, com None para os não encontrados
+        extracted_data.update(local_data)
+        return {field: extracted_data.get(field) for field in DOCUMENT_FIELD_DESCRIPTIONS}
 
+    # Salvaguarda: com o esquema de resposta, só ocorre se o stream for interrompido no meio do JSON
     except json.JSONDecodeError as json_err:
         st.error(f"Erro ao decodificar a resposta JSON da API: {json_err}")
         st.text("Resposta recebida da API (pode não ser JSON válido):")
@@ -248,6 +1022,29 @@ def analyze_text_with_ai(text, api_key):
         return {"Erro": f"Erro na API Gemini: {error_details}"}
 
 
+# Qualidade do JPEG da pré-visualização guardado na sessão.
+PREVIEW_JPEG_QUALITY = 80
+
+
+def get_session_preview(file_bytes, file_type, file_hash, dpi=OCR_DPI):
+    """
+    Retorna a pré-visualização guardada na sessão para este arquivo (JPEG em bytes, ou None),
+    gerando-a apenas na primeira vez. Guardar o JPEG já codificado evita que o st.image recodifique
+    a imagem PIL em PNG a cada rerun; para documentos digitalizados o JPEG também é bem menor.
+    Em PDFs a chave inclui a resolução: ao mudar o DPI, a primeira página é renderizada de novo nessa
+    resolução, e o OCR reaproveita essa renderização.
+    """
+    preview_key = f"preview_jpg_{file_hash}_{dpi}" if file_type == 'application/pdf' else f"preview_jpg_{file_hash}"
+    if st.session_state.get(preview_key) is None:
+        preview_image = render_preview(file_bytes, file_type, dpi)
+        if preview_image is None:
+            return None
+        jpeg_buffer = io.BytesIO()
+        preview_image.convert('RGB').save(jpeg_buffer, format='JPEG', quality=PREVIEW_JPEG_QUALITY, optimize=True)
+        st.session_state[preview_key] = jpeg_buffer.getvalue()
+    return st.session_state[preview_key]
+
+
 # 4. Interface do Aplicativo Streamlit (UI Principal Atualizada)
 st.set_page_config(layout="wide", page_title="OCR e Análise Gemini")
 
@@ -259,6 +1056,12 @@ api_key_input = st.sidebar.text_input(
     type="password",
     help="Sua chave da API do Google Gemini.")
 
+st.sidebar.subheader("OCR")
+ocr_dpi = st.sidebar.slider(
+    "Resolução do OCR para PDFs (DPI):",
+    min_value=100, max_value=400, value=OCR_DPI, step=50,
+    help="Aumente para digitalizações de baixa qualidade. Valores maiores deixam o OCR mais lento.")
+
 
 
 # --- Área Principal ---
@@ -272,24 +1075,21 @@ uploaded_file = st.file_uploader(
     key="file_uploader"
 )
 
-if 'ocr_text' not in st.session_state:
-    st.session_state.ocr_text = None
-if 'structured_data' not in st.session_state:
-    st.session_state.structured_data = None
-if 'last_uploaded_filename' not in st.session_state:
-     st.session_state.last_uploaded_filename = None
-
-if uploaded_file and uploaded_file.name != st.session_state.get('last_uploaded_filename'):
-    st.session_state.ocr_text = None
-    st.session_state.structured_data = None
-    st.session_state.last_uploaded_filename = uploaded_file.name
-    # st.info(f"Novo arquivo detectado: {uploaded_file.name}. Estados anteriores resetados.") # Opcional: Mostrar mensagem de reset
-
-
 if uploaded_file is not None:
     file_bytes = uploaded_file.getvalue()
     file_type = uploaded_file.type
     file_name = uploaded_file.name
+    # A resolução só se aplica à renderização de PDFs: para imagens, o valor fixo mantém os caches
+    # do OCR e da pré-visualização válidos quando o controle deslizante é alterado.
+    file_dpi = ocr_dpi if file_type == 'application/pdf' else OCR_DPI
+
+    # Estados da sessão indexados pelo hash do conteúdo: interações com outros widgets nunca
+    # invalidam os resultados, e voltar a um arquivo já processado não exige novo OCR.
+    file_hash = hashlib.sha256(file_bytes).hexdigest()
+    ocr_key = f"ocr_text_{file_hash}"
+    data_key = f"structured_data_{file_hash}"
+    st.session_state.setdefault(ocr_key, None)
+    st.session_state.setdefault(data_key, None)
 
     st.write("---")
     st.write(f"Arquivo carregado: **{file_name}** ({file_type})")
@@ -301,21 +1101,18 @@ if uploaded_file is not None:
         # ... (código de visualização inalterado da v1.3) ...
         try:
             if file_type in ['image/png', 'image/jpeg', 'image/jpg']:
-                image = Image.open(io.BytesIO(file_bytes))
+                image = get_session_preview(file_bytes, file_type, file_hash, file_dpi)
                 st.image(image, caption='Imagem Carregada', use_container_width='auto')
             elif file_type == 'application/pdf':
                 st.info("Exibindo a primeira página do PDF...")
                 try:
-                    preview_images = convert_from_bytes(file_bytes, dpi=150, first_page=1, last_page=1)
-                    if preview_images:
-                        st.image(preview_images[0], caption='Primeira Página do PDF', use_container_width='auto')
+                    preview_image = get_session_preview(file_bytes, file_type, file_hash, file_dpi)
+                    if preview_image is not None:
+                        st.image(preview_image, caption='Primeira Página do PDF', use_container_width='auto')
                     else:
-                        st.warning("Não foi possível gerar a visualização do PDF (pdf2image retornou vazio).")
+                        st.warning("Não foi possível gerar a visualização do PDF (o documento não possui páginas).")
                 except Exception as pdf_prev_err:
-                     if 'poppler' in str(pdf_prev_err).lower():
-                          st.error("Erro na visualização do PDF: 'poppler' não encontrado.")
-                     else:
-                          st.error(f"Erro ao gerar pré-visualização do PDF: {pdf_prev_err}")
+                     st.error(f"Erro ao gerar pré-visualização do PDF: {pdf_prev_err}")
             else:
                 st.warning("Visualização não disponível para este tipo de arquivo.")
         except Exception as e:
@@ -324,67 +1121,67 @@ if uploaded_file is not None:
 
     with col2:
         st.subheader("Ações")
-        # Botão OCR
-        if st.button("1. Extrair Texto (OCR)", key="ocr_button"):
-            st.session_state.ocr_text = None
-            st.session_state.structured_data = None
-            with st.spinner('Processando OCR...'):
-                _, ocr_result = perform_ocr(file_bytes, file_type)
-                if ocr_result is not None:
-                     if ocr_result.strip():
-                          st.session_state.ocr_text = ocr_result
-                          st.success("OCR Concluído!")
-                     else:
-                          st.warning("OCR concluído, mas nenhum texto foi detectado.")
-                          st.session_state.ocr_text = ""
-                else:
+        # Um único botão: OCR seguido da análise com o Gemini (se houver API Key)
+        if st.button("Processar Documento", key="process_button"):
+            st.session_state[ocr_key] = None
+            st.session_state[data_key] = None
+            if api_key_input:
+                # A importação da biblioteca do Gemini (centenas de ms) ocorre em paralelo com o OCR
+                threading.Thread(target=_get_genai, daemon=True).start()
+            with st.status("Processando documento...", expanded=True) as status:
+                st.write("Extraindo texto (OCR)...")
+                ocr_result = perform_ocr(file_bytes, file_type, file_dpi)
+                if ocr_result is None:
                      st.error("Falha no processo de OCR.")
-
-        # Botão Análise Gemini
-        analysis_possible = st.session_state.ocr_text is not None and api_key_input
-        analyze_button_disabled = not analysis_possible
-
-        if st.button("2. Analisar Dados (Gemini API)", key="analyze_button", disabled=analyze_button_disabled):
-            if not api_key_input:
-                 st.warning("Por favor, insira sua chave da API Gemini na barra lateral.")
-            elif st.session_state.ocr_text is None:
-                 st.warning("Execute o OCR primeiro (Botão 1).")
-            else:
-                 # Caso normal (inclui texto vazio, a função analyze_text_with_ai trata isso)
-                 st.session_state.structured_data = None
-                 with st.spinner("Chamando API Gemini para análise..."):
-                     analysis_result = analyze_text_with_ai(st.session_state.ocr_text, api_key_input)
-                     st.session_state.structured_data = analysis_result
-                     if isinstance(analysis_result, dict) and "Erro" in analysis_result:
-                          st.error("Falha na análise com Gemini. Verifique os erros acima e sua API Key.")
+                     # Não mantém falhas no cache, para que uma nova tentativa execute o OCR de novo
+                     perform_ocr.clear(file_bytes, file_type, file_dpi)
+                     status.update(label="Falha no OCR.", state="error")
+                else:
+                     st.session_state[ocr_key] = ocr_result
+                     if not ocr_result.strip():
+                          st.warning("OCR concluído, mas nenhum texto foi detectado.")
+                          status.update(label="OCR concluído, sem texto detectado.", state="complete")
+                     elif not api_key_input:
+                          status.update(label="OCR concluído (análise com Gemini não realizada).", state="complete")
                      else:
-                          st.success("Análise com Gemini concluída!")
+                          st.write(f"Analisando dados com a API Gemini (modelo: {GEMINI_MODEL_NAME})...")
+                          analysis_result = analyze_text_with_ai(ocr_result, api_key_input)
+                          st.session_state[data_key] = analysis_result
+                          if isinstance(analysis_result, dict) and "Erro" in analysis_result:
+                               st.error("Falha na análise com Gemini. Verifique os erros acima e sua API Key.")
+                               # Erros (cota, rede, chave inválida) não devem ficar no cache
+                               clear_cached_analysis(ocr_result)
+                               status.update(label="Falha na análise com Gemini.", state="error")
+                          elif isinstance(analysis_result, dict) and "Aviso" in analysis_result:
+                               # Exibido como aviso na seção de resultados
+                               status.update(label="OCR concluído (análise com Gemini não realizada).", state="complete")
+                          else:
+                               status.update(label="Documento processado!", state="complete")
 
-        # Mensagens de ajuda para o botão desabilitado
-        elif analyze_button_disabled:
-             if not api_key_input:
-                  st.info("Insira sua API Key na barra lateral para habilitar a análise.")
-             elif st.session_state.ocr_text is None:
-                  st.info("Execute o passo 1 (OCR) primeiro.")
+        # Mensagem de ajuda: sem API Key, apenas o OCR é realizado
+        if not api_key_input:
+             st.info("Insira sua API Key na barra lateral para também analisar os dados com o Gemini.")
 
 
     # Exibição dos resultados
     st.write("---")
 
-    if st.session_state.ocr_text is not None:
+    if st.session_state[ocr_key] is not None:
         st.subheader("Texto Extraído via OCR")
         st.text_area(
              "Resultado do OCR:",
-             st.session_state.ocr_text if st.session_state.ocr_text.strip() else "[Nenhum texto detectado pelo OCR]",
+             st.session_state[ocr_key] if st.session_state[ocr_key].strip() else "[Nenhum texto detectado pelo OCR]",
              height=250
         )
 
     # --- EXIBIÇÃO DOS DADOS ESTRUTURADOS (MODIFICADO) ---
-    if st.session_state.structured_data is not None:
+    if st.session_state[data_key] is not None:
         st.subheader("Dados Estruturados (Análise Gemini API)")
-        if isinstance(st.session_state.structured_data, dict) and "Erro" in st.session_state.structured_data:
+        if isinstance(st.session_state[data_key], dict) and "Erro" in st.session_state[data_key]:
              pass # Erro já tratado visualmente
-        elif isinstance(st.session_state.structured_data, dict):
+        elif isinstance(st.session_state[data_key], dict) and "Aviso" in st.session_state[data_key]:
+             st.info(st.session_state[data_key]["Aviso"])
+        elif isinstance(st.session_state[data_key], dict):
             data_map = {
                 "nome": "Nome e Sobrenome",
                 "data_nascimento": "Data de Nascimento",
@@ -399,7 +1196,7 @@ if uploaded_file is not None:
             }
             found_count = 0
             st.write("Valores extraídos (clique no ícone para copiar):") # Adiciona um título
-            for key, value in st.session_state.structured_data.items():
+            for key, value in st.session_state[data_key].items():
                 display_name = data_map.get(key, key.replace("_", " ").title())
                 # Mostra o valor mesmo que seja null/None ou vazio
                 value_str = str(value) if value is not None else ""
@@ -411,18 +1208,18 @@ if uploaded_file is not None:
                 if value:
                      found_count += 1
 
-            if found_count == 0 and not ("Erro" in st.session_state.structured_data):
+            if found_count == 0 and not ("Erro" in st.session_state[data_key]):
                  st.warning("A API Gemini processou o texto, mas não retornou valores preenchidos para os campos esperados.")
 
             expected_keys = data_map.keys()
-            returned_keys = st.session_state.structured_data.keys()
+            returned_keys = st.session_state[data_key].keys()
             missing_keys = [data_map[k] for k in expected_keys if k not in returned_keys]
             if missing_keys:
                 st.markdown(f"**Campos não retornados pela API (chave ausente):** {', '.join(missing_keys)}")
         else:
             st.error("A resposta da análise da API não foi um dicionário JSON válido.")
             st.text("Resposta recebida:")
-            st.code(str(st.session_state.structured_data), language=None)
+            st.code(str(st.session_state[data_key]), language=None)
 
 else:
     st.info("Aguardando o upload de um arquivo PDF, PNG ou JPG.")